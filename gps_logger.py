@@ -1,128 +1,301 @@
 #!/usr/bin/env python3
-import csv, json, subprocess, time, sys, os
+import argparse, asyncio, time, sys, os, signal, shlex, threading
 from datetime import datetime, timezone
+try:
+    from orjson import loads as json_loads  # C parser, takes bytes; optional
+except ImportError:
+    from json import loads as json_loads
 
-# Usage: python gps_logger.py [output_csv] [interval_seconds]
-OUT = sys.argv[1] if len(sys.argv) > 1 else "gps_log.csv"
-INTERVAL = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
-
+# Usage: python gps_logger.py [output_csv] [interval_seconds] [--providers network,gps] [--reuse-sec 10]
 SESSION = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
 FIELDS = [
     "session_id","timestamp_ms","timestamp_iso",
     "latitude","longitude","accuracy_m","speed_mps",
     "bearing_deg","altitude_m","provider","raw_provider",
-    "source","reused"
+    "source","reused","dup_count"
 ]
 
-LAST_LOC = None
-LAST_TIME = None
-REUSE_MAX_AGE_SEC = 10  # reuse last fix up to 10s old if needed
+PROVIDERS = ("gps", "network", "passive")  # what termux-location -p accepts
+# Any command printing one JSON fix per update can replace termux-location
+STREAM_CMD = shlex.split(os.environ.get("GPS_STREAM_CMD", ""))
+DEDUP_EPS_DEG = 1e-6  # lat/lon change below this counts as the same fix...
+MAX_DEDUP_SECS = 30   # ...and is skipped for at most this long
+FLUSH_BYTES = 4096  # wake the CSV writer once this much is buffered...
+BATCH_SECONDS = 10  # ...or after this many seconds, whichever comes first
+FSYNC_EVERY = 8     # fdatasync the CSV every this many written batches
 
-def run_cmd(args, timeout):
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+async def stop_stream(proc):
+    # Signal the whole process group so the Termux:API helper dies too
     try:
-        out, err = p.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        p.kill()
-        return None, "timeout"
-    rc = p.returncode
-    return (out if rc == 0 else None), (err.strip() if err else f"rc={rc}")
-
-def get_network_once(timeout=8):
-    # Valid flags are only -p and -r; no -d supported
-    out, err = run_cmd(["termux-location","-p","network","-r","once"], timeout)
-    if not out:
-        raise RuntimeError(f"network once failed: {err}")
-    loc = json.loads(out)
-    if "latitude" in loc and "longitude" in loc:
-        loc["_provider_used"] = "network"
-        loc["_source"] = "once"
-        return loc
-    raise RuntimeError("network once: no lat/lon")
-
-def get_last(timeout=3):
-    out, err = run_cmd(["termux-location","-r","last"], timeout)
-    if not out:
-        raise RuntimeError(f"last failed: {err}")
-    loc = json.loads(out)
-    if "latitude" in loc and "longitude" in loc:
-        # provider may be gps/network/fused; keep whatever is reported
-        loc["_provider_used"] = loc.get("provider","network")
-        loc["_source"] = "last"
-        return loc
-    raise RuntimeError("last: no lat/lon")
+        os.killpg(proc.pid, signal.SIGTERM)
+        await asyncio.sleep(0.2)
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
 
-def write_header_if_needed(path, fieldnames):
-    exists = os.path.exists(path) and os.path.getsize(path) > 0
-    f = open(path, "a", newline="")
-    w = csv.DictWriter(f, fieldnames=fieldnames)
-    if not exists:
-        w.writeheader()
-    return f, w
-
-def to_row(loc, reused=False):
-    ts_ms = int(loc.get("time", time.time()*1000))
-    ts_iso = datetime.fromtimestamp(ts_ms/1000, tz=timezone.utc).isoformat()
-    return {
-        "session_id": SESSION,
-        "timestamp_ms": ts_ms,
-        "timestamp_iso": ts_iso,
-        "latitude": loc.get("latitude"),
-        "longitude": loc.get("longitude"),
-        "accuracy_m": loc.get("accuracy"),
-        "speed_mps": loc.get("speed"),
-        "bearing_deg": loc.get("bearing"),
-        "altitude_m": loc.get("altitude"),
-        "provider": loc.get("provider","network"),
-        "raw_provider": loc.get("_provider_used","network"),
-        "source": loc.get("_source","once"),
-        "reused": int(1 if reused else 0),
-    }
-
-def main():
-    global LAST_LOC, LAST_TIME
-    print(f"Logging NETWORK provider to {OUT} every {INTERVAL}s. Ctrl+C to stop.", flush=True)
-    f, w = write_header_if_needed(OUT, FIELDS)
-    missed = 0
+async def stream_fixes(providers, first_fix_sec, stall_sec):
+    # Yields fixes from one long-lived stream; the next provider takes over on exit, stall or no first fix
+    attempt = 0
+    while True:
+        provider = providers[attempt % len(providers)]
+        attempt += 1
+        proc = await asyncio.create_subprocess_exec(
+            *(STREAM_CMD or ["termux-location","-p",provider,"-r","updates"]),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True)
+        buf = b""
+        timeout = first_fix_sec
+        try:
+            while True:
+                line = await asyncio.wait_for(proc.stdout.readline(), timeout=timeout)
+                if not line:
+                    print(f"Location stream exited (rc={await proc.wait()}); restarting", file=sys.stderr)
+                    await asyncio.sleep(1)
+                    break
+                # A "{" in column 0 starts a new object; drop whatever was left over
+                buf = line if line.startswith(b"{") else buf + line
+                if not line.rstrip().endswith(b"}"):
+                    continue
+                try:
+                    loc = json_loads(buf)
+                except ValueError:
+                    continue
+                buf = b""
+                if isinstance(loc, dict) and "latitude" in loc and "longitude" in loc:
+                    loc["_provider_used"] = provider
+                    loc["_source"] = "updates"
+                    timeout = stall_sec
+                    yield loc
+        except asyncio.TimeoutError:
+            print(f"No {provider} update in {timeout:g}s; restarting stream", file=sys.stderr)
+        finally:
+            await stop_stream(proc)
+
+def csv_cell(v):
+    if v is None:
+        return ""
+    if isinstance(v, str) and (',' in v or '"' in v or '\n' in v or '\r' in v):
+        return '"' + v.replace('"', '""') + '"'
+    return str(v)
+
+ROW_FMT = ",".join(["{}"] * len(FIELDS)) + "\r\n"
+TEXT_COLS = (9, 10, 11)  # provider, raw_provider, source: free text from the device
+
+def format_row(row, _fmt=ROW_FMT.format, _cell=csv_cell):
+    # Same bytes as csv.writer; only TEXT_COLS can need quoting
+    cells = ["" if v is None else v for v in row]
+    for i in TEXT_COLS:
+        cells[i] = _cell(row[i])
+    return _fmt(*cells).encode()
+
+def pwrite_all(fd, data, offset):
+    while data:
+        n = os.pwrite(fd, data, offset)
+        offset += n
+        data = data[n:]
+    return offset
+
+def csv_writer(fd, tail, buf, lock, wake, stop, failed):
+    # Writer thread: pwrite what the sampler buffered every BATCH_SECONDS; errors go to failed()
+    batches = 0
     try:
         while True:
-            loop_start = time.time()
-            loc = None
-            # 1) Try immediate network fix (request once)
-            try:
-                loc = get_network_once(timeout=8)
-            except Exception as e1:
-                # 2) Fallback to last-known fix to avoid gaps
-                try:
-                    loc = get_last(timeout=3)
-                except Exception as e2:
-                    loc = None
-                    print(f"No network fix: {e1}; no last fix: {e2}", file=sys.stderr)
-
-            if loc:
-                LAST_LOC = loc
-                LAST_TIME = time.time()
-                w.writerow(to_row(loc, reused=False))
-                f.flush()
-                missed = 0
-            else:
-                # 3) Reuse the last emitted fix briefly
-                if LAST_LOC and LAST_TIME and (time.time() - LAST_TIME) <= REUSE_MAX_AGE_SEC:
-                    w.writerow(to_row(LAST_LOC, reused=True))
-                    f.flush()
+            wake.wait(BATCH_SECONDS)
+            wake.clear()
+            stopping = stop.is_set()
+            with lock:
+                data = bytes(buf)
+                buf.clear()
+            if data:
+                tail = pwrite_all(fd, data, tail)
+                batches += 1
+                if batches % FSYNC_EVERY == 0:
+                    os.fdatasync(fd)
+            if stopping:
+                os.fdatasync(fd)
+                return
+    except OSError as e:
+        failed(e)
+
+def write_header_if_needed(path, fieldnames):
+    # Returns (fd, tail); refuses to append under a different header
+    header = format_row(fieldnames)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    tail = os.fstat(fd).st_size
+    if tail == 0:
+        tail = pwrite_all(fd, header, tail)
+    elif os.pread(fd, len(header) + 1, 0).split(b"\n", 1)[0].rstrip(b"\r") != header.rstrip(b"\r\n"):
+        os.close(fd)
+        sys.exit(f"{path} has a different header (older log format?); log to a new file")
+    return fd, tail
+
+ISO_DAY = (None, "")  # (UTC day number, its "YYYY-MM-DDT" prefix) for iso_utc
+
+def iso_utc(ts_ms):
+    # isoformat(timespec="microseconds") text; the date prefix is cached per UTC day
+    global ISO_DAY
+    s, ms = divmod(ts_ms, 1000)
+    day, sec = divmod(s, 86400)
+    if day != ISO_DAY[0]:
+        tm = time.gmtime(day * 86400)
+        ISO_DAY = (day, f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}T")
+    h, sec = divmod(sec, 3600)
+    m, sec = divmod(sec, 60)
+    return f"{ISO_DAY[1]}{h:02d}:{m:02d}:{sec:02d}.{ms:03d}000+00:00"
+
+def to_row(loc, now_ms, reused=False, dup_count=0, _iso=iso_utc, _session=SESSION):
+    # Tuple in FIELDS order; now_ms stands in when the fix has no "time"
+    g = loc.get
+    ts_ms = int(g("time", now_ms))
+    return (
+        _session, ts_ms, _iso(ts_ms),
+        g("latitude"), g("longitude"), g("accuracy"), g("speed"),
+        g("bearing"), g("altitude"), g("provider","network"), g("_provider_used","network"),
+        g("_source","once"), 1 if reused else 0, dup_count,
+    )
+
+def provider_list(value):
+    providers = [p.strip() for p in value.split(",") if p.strip()]
+    bad = [p for p in providers if p not in PROVIDERS]
+    if not providers or bad:
+        raise argparse.ArgumentTypeError(f"expected a comma-separated list of {', '.join(PROVIDERS)}")
+    return providers
+
+def build_parser(description="Log termux-location fixes to CSV."):
+    ap = argparse.ArgumentParser(description=description)
+    ap.add_argument("out", nargs="?", default="gps_log.csv", help="output CSV (appended to)")
+    ap.add_argument("interval", nargs="?", type=float, default=1.0, help="seconds between rows")
+    ap.add_argument("--providers", type=provider_list, default=["network"],
+                    help="provider fallback chain, tried in order when the stream stalls (default: network)")
+    ap.add_argument("--reuse-sec", type=float, default=10,
+                    help="reuse the last fix for up to this many seconds when no new one arrives")
+    ap.add_argument("--first-fix-sec", type=float, default=60,
+                    help="wait this long for a provider's first fix before trying the next (GPS cold starts are slow)")
+    ap.add_argument("--stall-sec", type=float, default=30,
+                    help="restart the location stream after this long without an update")
+    return ap
+
+async def run(args, on_row=None):
+    # Shared logging loop; on_row(row, loc, reused) is called for each row written
+    fd, tail = write_header_if_needed(args.out, FIELDS)
+    interval = args.interval
+    loop = asyncio.get_running_loop()
+    buf = bytearray()  # formatted CSV lines waiting for csv_writer
+    buf_lock = threading.Lock()
+    wake = threading.Event()
+    stop = threading.Event()
+    fresh = None
+    last = None  # (last fix, monotonic time until which it may be reused)
+
+    async def gps_task():
+        # Keep the latest fix; tick_task decides what gets logged
+        nonlocal fresh, last
+        async for loc in stream_fixes(args.providers, args.first_fix_sec, args.stall_sec):
+            # One slot, so the fix and its reuse deadline are always a pair
+            last = (loc, loop.time() + args.reuse_sec)
+            fresh = loc
+
+    async def tick_task():
+        # Snapshot the latest fix every interval seconds on absolute monotonic deadlines
+        nonlocal fresh
+        missed = 0
+        last_emit = None  # (lat, lon, tick time) of the last row written
+        dups = 0
+        skipped = None  # the last fix skipped as a duplicate
+
+        def emit(loc, reused, dup_count):
+            row = to_row(loc, int(time.time()*1000), reused, dup_count)
+            line = format_row(row)
+            with buf_lock:
+                buf.extend(line)
+                full = len(buf) >= FLUSH_BYTES
+            if full:
+                wake.set()
+            if on_row:
+                on_row(row, loc, reused)
+
+        next_t = loop.time()
+        try:
+            while True:
+                next_t += interval
+                now = loop.time()
+                if next_t <= now:
+                    next_t = now + interval
+                await asyncio.sleep(next_t - now)
+                # next_t is "now" (monotonic) for the rest of the tick
+                if fresh is not None:
+                    loc, reused = fresh, False
+                    fresh = None
+                    missed = 0
+                elif last is not None and next_t <= last[1]:
+                    # Reuse the last emitted fix briefly
+                    loc, reused = last[0], True
                 else:
                     missed += 1
                     print(f"No fix emitted ({missed})", file=sys.stderr)
+                    continue
+                # Skip a stationary fix and count it in the next row's dup_count
+                lat = loc["latitude"]; lon = loc["longitude"]
+                if ((not reused or loc is skipped) and last_emit
+                        and abs(lat - last_emit[0]) < DEDUP_EPS_DEG and abs(lon - last_emit[1]) < DEDUP_EPS_DEG
+                        and next_t - last_emit[2] < MAX_DEDUP_SECS):
+                    dups += 1
+                    skipped = loc
+                    continue
+                emit(loc, reused, dups)
+                last_emit = (lat, lon, next_t)
+                dups = 0
+        finally:
+            # Write the last skipped duplicate so dup_count covers every tick
+            if dups:
+                emit(skipped, False, dups - 1)
 
-            # Pace the loop to INTERVAL seconds including command latency
-            elapsed = time.time() - loop_start
-            sleep_for = INTERVAL - elapsed
-            if sleep_for > 0:
-                time.sleep(sleep_for)
-    except KeyboardInterrupt:
-        pass
+    me = asyncio.current_task()
+    write_errors = []
+
+    def writer_failed(e):
+        # Writer thread failed: stop logging; run() re-raises the error
+        write_errors.append(e)
+        loop.call_soon_threadsafe(me.cancel)
+
+    writer = threading.Thread(target=csv_writer, args=(fd, tail, buf, buf_lock, wake, stop, writer_failed),
+                              daemon=True)
+    writer.start()
+    # SIGTERM and SIGHUP unwind like Ctrl+C; an ignored SIGHUP (nohup) stays ignored
+    sigs = [signal.SIGTERM]
+    if signal.getsignal(signal.SIGHUP) is not signal.SIG_IGN:
+        sigs.append(signal.SIGHUP)
+    for sig in sigs:
+        loop.add_signal_handler(sig, me.cancel)
+    tasks = [asyncio.create_task(c) for c in (gps_task(), tick_task())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            t.result()
     finally:
-        f.close()
+        try:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Runs even if a second Ctrl+C cancels the wait above
+            stop.set()
+            wake.set()
+            writer.join()
+            os.close(fd)
+            for sig in sigs:
+                loop.remove_signal_handler(sig)
+            if write_errors:
+                raise write_errors[0]
+
+async def main():
+    args = build_parser().parse_args()
+    print(f"Logging {','.join(args.providers).upper()} to {args.out} every {args.interval}s. Ctrl+C to stop.", flush=True)
+    await run(args)
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
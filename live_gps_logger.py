@@ -1,148 +1,165 @@
 #!/usr/bin/env python3
-import csv, json, subprocess, time, sys, os, math, threading
-from datetime import datetime, timezone
+import asyncio, json, time, sys, os, math, threading, queue, itertools
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from orjson import dumps as json_dumps, loads as json_loads  # C codec, bytes in/out; optional
+except ImportError:
+    from json import loads as json_loads
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+from gps_logger import SESSION, build_parser, run
 
-OUT = sys.argv[1] if len(sys.argv) > 1 else "gps_log.csv"
-INTERVAL = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
-SESSION = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-
-FIELDS = [
-    "session_id","timestamp_ms","timestamp_iso",
-    "latitude","longitude","accuracy_m","speed_mps",
-    "bearing_deg","altitude_m","provider","raw_provider",
-    "source","reused"
-]
-
-LAST_LOC = None
-LAST_TIME = None
-REUSE_MAX_AGE_SEC = 10
+# Usage: python live_gps_logger.py [output_csv] [interval_seconds] [--providers ...] [--reuse-sec N]
 
 FIREBASE_DB_URL = os.environ.get("FIREBASE_DB_URL","").rstrip("/")
 FIREBASE_AUTH   = os.environ.get("FIREBASE_AUTH")
 JC_KEY          = os.environ.get("JCDECAUX_API_KEY")
 BIKES_POLL_SECS = float(os.environ.get("BIKES_POLL_SECS","60"))
+BIKES_BACKOFF_MAX = 300  # failed polls are retried after 1, 2, 4, ... s, up to this
 
 JCD_URL = "https://api.jcdecaux.com/vls/v1/stations" 
 
-# Shared latest bikes snapshot for nearest lookup
-BIKES_LOCK = threading.Lock()
-LATEST_STATIONS = []  # list of dicts with lat, lon, name, available_bikes, available_stands
+# (stations with coords, lat/lon in radians, cos lat); replaced whole by bikes_poller, read without a lock
+SNAPSHOT = None
+
+# Rows waiting for the background Firebase poster; the sampler never blocks on the network
+POST_Q = queue.Queue(maxsize=5000)
+UPLOAD_BATCH = 64  # points per Firebase PATCH...
+UPLOAD_WAIT = 2.0  # ...or whatever arrived within this many seconds of the first
+# Keep-alive pool shared by every HTTP call; client-keyed PATCHes are safe to retry
+SESSION_HTTP = requests.Session()
+SESSION_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.3,
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"})))
+JSON_HEADERS = {"Content-Type": "application/json"}
+AUTH_PARAMS = {"auth": FIREBASE_AUTH} if FIREBASE_AUTH else None  # let requests build the query string
 
 def fb_url(path):
     if not FIREBASE_DB_URL:
         return ""
-    url = f"{FIREBASE_DB_URL}/{path.lstrip('/')}.json"
-    if FIREBASE_AUTH:
-        sep = '&' if '?' in url else '?'
-        url = f"{url}{sep}auth={FIREBASE_AUTH}"
-    return url
+    return f"{FIREBASE_DB_URL}/{path.lstrip('/')}.json"
 
+# Fixed for the run; None when Firebase is off
+POINTS_URL = fb_url(f"sessions/{SESSION}/points") if FIREBASE_DB_URL else None
+META_URL = fb_url(f"sessions/{SESSION}/meta") if FIREBASE_DB_URL else None
+BIKES_URL = fb_url("open_data/dublin_bikes/items") if FIREBASE_DB_URL else None
+POINT_SEQ = itertools.count()
+# Left out of each point; written once to sessions/<id>/meta
+POINT_DEFAULTS = {"prov": "network", "raw": "network", "src": "updates", "reused": 0, "dup": 0}
 
-def post_point(session_id, row):
-    if not FIREBASE_DB_URL:
-        return
+def point_doc(row):
+    # Short keys; nulls, POINT_DEFAULTS values and derivable fields are omitted
+    (_, ts_ms, _, lat, lon, acc, speed, bearing, alt,
+     provider, raw_provider, source, reused, dup_count) = row
     doc = {
-        "timestamp_ms": row["timestamp_ms"],
-        "timestamp_iso": row["timestamp_iso"],
-        "lat": row["latitude"],
-        "lon": row["longitude"],
-        "accuracy_m": row["accuracy_m"],
-        "speed_mps": row["speed_mps"],
-        "bearing_deg": row["bearing_deg"],
-        "altitude_m": row["altitude_m"],
-        "provider": row["provider"],
-        "raw_provider": row["raw_provider"],
-        "source": row["source"],
-        "reused": row["reused"],
-        "source_type": "device"
+        "t": ts_ms,
+        "lat": lat,
+        "lon": lon,
+        "acc": acc,
+        "spd": speed,
+        "brg": bearing,
+        "alt": alt,
+        "prov": provider,
+        "raw": raw_provider,
+        "src": source,
+        "reused": reused,
+        "dup": dup_count,
     }
+    return {k: v for k, v in doc.items() if v is not None and v != POINT_DEFAULTS.get(k)}
+
+def post_session_meta():
+    # Returns True once written; the poster retries it ahead of every batch until then
+    meta = {"session_id": SESSION, "source_type": "device", "point_defaults": POINT_DEFAULTS}
     try:
-        requests.post(fb_url(f"sessions/{session_id}/points"), json=doc, timeout=5)
+        r = SESSION_HTTP.patch(META_URL, data=json_dumps(meta), params=AUTH_PARAMS,
+                               headers=JSON_HEADERS, timeout=(2,5))
+        r.raise_for_status()
+        return True
     except Exception as e:
-        print(f"Warn: Firebase post failed: {e}", file=sys.stderr)
+        print(f"Warn: Firebase post failed (meta): {e}", file=sys.stderr)
+        return False
 
-def post_bike_item(item):
-    if not FIREBASE_DB_URL:
+def post_points(rows):
+    # Keys "<timestamp_ms>_<seq>" sort by time and stay unique for reused fixes
+    if POINTS_URL is None:
         return
+    docs = {f"{row[1]}_{next(POINT_SEQ)}": point_doc(row) for row in rows}
     try:
-        requests.post(fb_url("open_data/dublin_bikes/items"), json=item, timeout=6)
+        SESSION_HTTP.patch(POINTS_URL, data=json_dumps(docs), params=AUTH_PARAMS,
+                           headers=JSON_HEADERS, timeout=(2,5))
     except Exception as e:
-        print(f"Warn: Firebase post failed (bikes): {e}", file=sys.stderr)
-
-def run_cmd(args, timeout):
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    try:
-        out, err = p.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        p.kill()
-        return None, "timeout"
-    rc = p.returncode
-    return (out if rc == 0 else None), (err.strip() if err else f"rc={rc}")
+        print(f"Warn: Firebase post failed: {e}", file=sys.stderr)
 
-def get_network_once(timeout=8):
-    out, err = run_cmd(["termux-location","-p","network","-r","once"], timeout)
-    if not out:
-        raise RuntimeError(f"network once failed: {err}")
-    loc = json.loads(out)
-    if "latitude" in loc and "longitude" in loc:
-        loc["_provider_used"] = "network"
-        loc["_source"] = "once"
-        return loc
-    raise RuntimeError("network once: no lat/lon")
+def poster():
+    # Background thread: PATCH up to UPLOAD_BATCH rows gathered within UPLOAD_WAIT s; None stops it
+    meta_sent = post_session_meta()
+    done = False
+    while not done:
+        batch = [POST_Q.get()]
+        deadline = time.monotonic() + UPLOAD_WAIT
+        while len(batch) < UPLOAD_BATCH and batch[-1] is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(POST_Q.get(timeout=left))
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+        if batch:
+            if not meta_sent:
+                meta_sent = post_session_meta()
+            post_points(batch)
 
-def get_last(timeout=3):
-    out, err = run_cmd(["termux-location","-r","last"], timeout)
-    if not out:
-        raise RuntimeError(f"last failed: {err}")
-    loc = json.loads(out)
-    if "latitude" in loc and "longitude" in loc:
-        loc["_provider_used"] = loc.get("provider","network")
-        loc["_source"] = "last"
-        return loc
-    raise RuntimeError("last: no lat/lon")
+def post_bike_items(items):
+    # One PATCH for the snapshot, keyed "<poll timestamp_ms>_<station_id>" so every poll is kept
+    if BIKES_URL is None:
+        return
+    docs = {f"{d['timestamp_ms']}_{d['station_id']}": d for d in items}
+    try:
+        SESSION_HTTP.patch(BIKES_URL, data=json_dumps(docs),
+                           params=AUTH_PARAMS, headers=JSON_HEADERS, timeout=(2,6))
+    except Exception as e:
+        print(f"Warn: Firebase post failed (bikes): {e}", file=sys.stderr)
 
-def write_header_if_needed(path, fieldnames):
-    exists = os.path.exists(path) and os.path.getsize(path) > 0
-    f = open(path, "a", newline="")
-    w = csv.DictWriter(f, fieldnames=fieldnames)
-    if not exists:
-        w.writeheader()
-    return f, w
+EARTH_R_M = 6371000.0
 
-def to_row(loc, reused=False):
-    ts_ms = int(loc.get("time", time.time()*1000))
-    ts_iso = datetime.fromtimestamp(ts_ms/1000, tz=timezone.utc).isoformat()
-    return {
-        "session_id": SESSION,
-        "timestamp_ms": ts_ms,
-        "timestamp_iso": ts_iso,
-        "latitude": loc.get("latitude"),
-        "longitude": loc.get("longitude"),
-        "accuracy_m": loc.get("accuracy"),
-        "speed_mps": loc.get("speed"),
-        "bearing_deg": loc.get("bearing"),
-        "altitude_m": loc.get("altitude"),
-        "provider": loc.get("provider","network"),
-        "raw_provider": loc.get("_provider_used","network"),
-        "source": loc.get("_source","once"),
-        "reused": int(1 if reused else 0),
-    }
+# The haversine "a" term ranks distances; only the winner goes through _a_to_m
 
-def haversine_m(lat1, lon1, lat2, lon2):
-    R = 6371000.0
+def _a_term(lat1, lon1, lat2, lon2):
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlmb = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlmb/2)**2
-    return 2*R*math.asin(math.sqrt(a))
+    return math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlmb/2)**2
+
+def _a_to_m(a):
+    return 2*EARTH_R_M*math.asin(math.sqrt(a))
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    # Scalar version, kept for checking the vectorised one
+    return _a_to_m(_a_term(lat1, lon1, lat2, lon2))
+
+def _a_term_one_to_many(lat, lon, lats_rad, lons_rad, cos_lats):
+    # Station radians and cos(latitude) come precomputed with the snapshot
+    phi1 = math.radians(lat)
+    return np.sin((lats_rad - phi1)/2)**2 + math.cos(phi1)*cos_lats*np.sin((lons_rad - math.radians(lon))/2)**2
+
+def haversine_m_one_to_many(lat, lon, lats_rad, lons_rad, cos_lats):
+    return 2*EARTH_R_M*np.arcsin(np.sqrt(_a_term_one_to_many(lat, lon, lats_rad, lons_rad, cos_lats)))
 
 def bikes_fetch_normalize():
+    # Returns (docs, geo): geo is a SNAPSHOT tuple for the stations in docs
     if not JC_KEY:
-        return []
-    r = requests.get(JCD_URL, params={"contract":"dublin","apiKey":JC_KEY}, timeout=10)
+        return [], None
+    r = SESSION_HTTP.get(JCD_URL, params={"contract":"dublin","apiKey":JC_KEY}, timeout=10)
     r.raise_for_status()
-    arr = r.json()
+    arr = json_loads(r.content)  # parse the raw body; skips requests' charset sniffing
     now_ms = int(time.time()*1000)
     docs = []
     for s in arr:
@@ -159,43 +176,48 @@ def bikes_fetch_normalize():
             "timestamp_ms": now_ms,
             "source_type": "open_data"
         })
-    return docs
+    geo = tuple(d for d in docs if d["lat"] is not None and d["lon"] is not None)
+    lats = np.deg2rad(np.array([d["lat"] for d in geo], dtype=np.float64))
+    lons = np.deg2rad(np.array([d["lon"] for d in geo], dtype=np.float64))
+    return docs, (geo, lats, lons, np.cos(lats))
 
 def bikes_poller():
-    # Background thread: poll JCDecaux and push to Firebase; keep LATEST_STATIONS for nearest lookup
+    # Background thread: poll JCDecaux, push to Firebase, publish SNAPSHOT; backs off after failures
+    global SNAPSHOT
+    next_t = time.monotonic()
+    backoff = 1.0
     while True:
-        t0 = time.time()
+        step = BIKES_POLL_SECS
         try:
-            docs = bikes_fetch_normalize()
+            docs, geo = bikes_fetch_normalize()
             if docs:
-                for d in docs:
-                    post_bike_item(d)
-                with BIKES_LOCK:
-                    # keep the latest snapshot in memory
-                    global LATEST_STATIONS
-                    LATEST_STATIONS = docs
+                post_bike_items(docs)
+                SNAPSHOT = geo
                 print(f"[bikes] pushed {len(docs)} stations; snapshot updated")
+            backoff = 1.0
         except Exception as e:
-            print(f"[bikes] poll error: {e}", file=sys.stderr)
-        dt = time.time() - t0
-        time.sleep(max(0, BIKES_POLL_SECS - dt))
+            print(f"[bikes] poll error: {e}; retrying in {backoff:g}s", file=sys.stderr)
+            step = backoff
+            backoff = min(backoff * 2, BIKES_BACKOFF_MAX)
+        next_t += step
+        now = time.monotonic()
+        if next_t <= now:
+            next_t = now + step
+        time.sleep(next_t - now)
 
 def nearest_station_to(lat, lon):
-    with BIKES_LOCK:
-        stations = list(LATEST_STATIONS)
-    best = None
-    best_d = float("inf")
-    for s in stations:
-        if s.get("lat") is None or s.get("lon") is None:
-            continue
-        d = haversine_m(lat, lon, s["lat"], s["lon"])
-        if d < best_d:
-            best_d = d; best = s
-    return best, best_d
+    # Haversine "a" against every station at once; one sqrt/asin for the winner
+    snap = SNAPSHOT
+    if snap is None or not snap[0]:
+        return None, float("inf")
+    stations, slat, slon, scos = snap
+    a = _a_term_one_to_many(lat, lon, slat, slon, scos)
+    i = int(np.argmin(a))
+    return stations[i], _a_to_m(float(a[i]))
 
-def main():
-    global LAST_LOC, LAST_TIME
-    print(f"Logging NETWORK provider to {OUT} every {INTERVAL}s; bikes poll {BIKES_POLL_SECS}s.", flush=True)
+async def main():
+    args = build_parser("Log termux-location fixes to CSV and stream them to Firebase.").parse_args()
+    print(f"Logging {','.join(args.providers).upper()} to {args.out} every {args.interval}s; bikes poll {BIKES_POLL_SECS}s.", flush=True)
     if not FIREBASE_DB_URL:
         print("Note: FIREBASE_DB_URL not set; cloud streaming disabled.", file=sys.stderr)
     if not JC_KEY:
@@ -204,53 +226,34 @@ def main():
     # Start bikes poller thread
     t = threading.Thread(target=bikes_poller, daemon=True)
     t.start()
+    poster_t = None
+    if FIREBASE_DB_URL:
+        poster_t = threading.Thread(target=poster, daemon=True)
+        poster_t.start()
 
-    f, w = write_header_if_needed(OUT, FIELDS)
-    missed = 0
-    try:
-        while True:
-            loop_start = time.time()
-            loc = None
+    def on_row(row, loc, reused):
+        if FIREBASE_DB_URL:
             try:
-                loc = get_network_once(timeout=8)
-            except Exception as e1:
-                try:
-                    loc = get_last(timeout=3)
-                except Exception as e2:
-                    loc = None
-                    print(f"No network fix: {e1}; no last fix: {e2}", file=sys.stderr)
+                POST_Q.put_nowait(row)
+            except queue.Full:
+                pass
 
-            if loc:
-                LAST_LOC = loc
-                LAST_TIME = time.time()
-                row = to_row(loc, reused=False)
-                w.writerow(row); f.flush()
-                post_point(SESSION, row)
+        # Nearest station print
+        if not reused:
+            best, d = nearest_station_to(loc["latitude"], loc["longitude"])
+            if best:
+                print(f"Nearest station: {best['name']} at {int(d)} m | bikes={best.get('available_bikes')} stands={best.get('available_stands')}")
 
-                # Nearest station print
-                lat = row["latitude"]; lon = row["longitude"]
-                if lat is not None and lon is not None:
-                    best, d = nearest_station_to(lat, lon)
-                    if best:
-                        print(f"Nearest station: {best['name']} at {int(d)} m | bikes={best.get('available_bikes')} stands={best.get('available_stands')}")
-                missed = 0
-            else:
-                if LAST_LOC and LAST_TIME and (time.time() - LAST_TIME) <= REUSE_MAX_AGE_SEC:
-                    row = to_row(LAST_LOC, reused=True)
-                    w.writerow(row); f.flush()
-                    post_point(SESSION, row)
-                else:
-                    missed += 1
-                    print(f"No fix emitted ({missed})", file=sys.stderr)
-
-            elapsed = time.time() - loop_start
-            sleep_for = INTERVAL - elapsed
-            if sleep_for > 0:
-                time.sleep(sleep_for)
-    except KeyboardInterrupt:
-        pass
+    try:
+        await run(args, on_row)
     finally:
-        f.close()
+        if poster_t:
+            # Let the poster send everything queued so far, then stop it
+            POST_Q.put(None)
+            poster_t.join(timeout=15)
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
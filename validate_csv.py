@@ -1,34 +1,38 @@
 #!/usr/bin/env python3
-import csv, sys, statistics as stats
+import sys
+import numpy as np
 
 inp = sys.argv[1] if len(sys.argv)>1 else "gps_log.csv"
-rows = []
+interval = float(sys.argv[2]) if len(sys.argv)>2 else 1.0  # the logger's interval_seconds
 with open(inp, newline="") as f:
-    r = csv.DictReader(f)
-    for row in r:
-        try:
-            row["timestamp_ms"] = int(row["timestamp_ms"])
-            for k in ["accuracy_m","speed_mps","bearing_deg","altitude_m"]:
-                row[k] = float(row[k]) if row.get(k) not in (None,"","null") else None
-            rows.append(row)
-        except Exception:
-            continue
+    header = f.readline().strip().split(",")
+    has_rows = any(line.strip() for line in f)  # stops at the first data line
+has_dup = "dup_count" in header
+if has_rows and "timestamp_ms" in header and "accuracy_m" in header:
+    # Unparsable cells become NaN; rows with the wrong field count are skipped
+    cols = [header.index("timestamp_ms"), header.index("accuracy_m")]
+    if has_dup:
+        cols.append(header.index("dup_count"))
+    data = np.genfromtxt(inp, delimiter=",", skip_header=1, usecols=cols, dtype=np.float64,
+                         invalid_raise=False).reshape(-1, len(cols))
+else:
+    # Empty, header-only or unrecognised file: no rows to summarise
+    data = np.empty((0, 3))
+data = data[~np.isnan(data[:,0])]
+data = data[data[:,0].argsort(kind="stable")]
+ts = data[:,0].astype(np.int64)
+dup = np.nan_to_num(data[:,2]) if has_dup else np.zeros(len(ts))
 
-rows.sort(key=lambda x:x["timestamp_ms"])
-n = len(rows)
-span = (rows[-1]["timestamp_ms"]-rows[0]["timestamp_ms"])/1000 if n>1 else 0
-gaps = []
-prev = None
-for r in rows:
-    if prev is not None:
-        dt = (r["timestamp_ms"]-prev)/1000
-        if dt > 2.5: gaps.append(dt)
-    prev = r["timestamp_ms"]
+n = len(ts)
+span = (ts[-1]-ts[0])/1000 if n>1 else 0
+dt = np.diff(ts)/1000
+# Ticks skipped as duplicates (dup_count) are not gaps
+gaps = dt[dt - dup[1:]*interval > 2.5]
 
-accs = [r["accuracy_m"] for r in rows if r["accuracy_m"] is not None]
-acc_summary = (min(accs), stats.mean(accs), max(accs)) if accs else (None, None, None)
+accs = data[:,1][~np.isnan(data[:,1])]
+acc_summary = (float(accs.min()), float(accs.mean()), float(accs.max())) if accs.size else (None, None, None)
 
 print(f"rows={n}")
 print(f"span_sec={span:.1f}")
-print(f"gaps_over_2.5s={len(gaps)}")
+print(f"gaps_over_2.5s={gaps.size}")
 print(f"accuracy_min_mean_max={acc_summary}")